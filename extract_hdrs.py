@@ -1,11 +1,11 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """extract_hdrs.py -- Extract "extern" function headers from .c files to .h files.
 
 Usage:
             ./extract_hdrs.py  [-h | -help | --help]
-            ./extract_hdrs.py  -kstate
-            ./extract_hdrs.py  [<c_file> <h_file> ...]
+            ./extract_hdrs.py  [-backup] -kstate
+            ./extract_hdrs.py  [-backup] [<c_file> <h_file> ...]
 
 If run with the '-kstate' switch, then it looks for the file 'kstate.c',
 and writes header information to 'kstate.h'. This is for convenience in the
@@ -17,6 +17,9 @@ and for each <name>.c file expects to extract headers to a corresponding
 
 Otherwise, it expects pairs of source .c file and target .h file.
 
+If the '-backup' switch is given, then when a .h file is rewritten, its
+previous content is kept as <h_file>.bak.
+
 In all cases, the target .h file must (a) exist and (b) contain a pair of
 start/end delimiters - as, for instance::
 
@@ -26,9 +29,8 @@ start/end delimiters - as, for instance::
     // -------- TEXT BEFORE THIS AUTOGENERATED - DO NOT EDIT --------
     Any text after the second delimiter is not altered
 
-A very simple regular expression is used to detect headers - basically, the
-header is from the opening ``/*`` to the ``)`` before the ``{`` in something
-like::
+A very simple scan is used to detect headers - basically, the header is from
+the opening ``/*`` to the ``)`` before the ``{`` in something like::
 
     /*
      * Header comment text
@@ -39,9 +41,18 @@ like::
 (and in general whitespace should be flexible in the actual function signature
 itself).
 
-Beware that the script does not check to see if the output header file will be
-given different content (apart from the timestamp) and will thus proceed
-regardless.
+The header file is only rewritten if the headers have actually changed. The
+timestamp line written after the start delimiter also records the SHA-1 of the
+C source the headers came from, and the version of this script's header
+finding. If the header file is newer than the C file, and both of those still
+match, the C file is not even scanned.
+
+The headers found in each C file are also remembered, along with the SHA-1
+of the file they came from, in ``$XDG_CACHE_HOME/kstate/extract-hdrs.json``
+(or ``~/.cache/kstate/extract-hdrs.json``), so that a C file whose headers
+have not changed (for instance, because only function bodies were edited)
+does not need to be scanned again on the next run. Entries for C files that
+no longer exist are dropped when the cache is saved.
 """
 
 # ***** BEGIN LICENSE BLOCK *****
@@ -69,59 +80,325 @@ regardless.
 #
 # ***** END LICENSE BLOCK *****
 
+import json
 import os
 import re
+import shutil
 import sys
 
 from datetime import datetime
 from difflib import ndiff
-
-pattern = r"""\
-(?P<header>                     # start of header group
-     \s* / \* .* \n             # start of header comment
-    (\s*   \* .* \n)*           # 0 or more comment lines
-     \s*   \* /  \n             # end of header comment
-     \s* extern \s+
-        (?P<type>               # crudely allow for type info
-          #(\w+ \s+) |                  # e.g., "fred "
-          (\w+ \s+ \** \s*) |           # e.g., "fred *"
-          (\w+ \s+ \w+ \s+ \** \s*)     # e.g., "struct fred " or "struct fred *"
-        )
-        (?P<name>
-            \w+                 # name of function
-        )
-     \(  ([^)]|\n)* \)          # crudely match arguments
-)                               # end of header group
-\s* \n
-\s* {
-"""
+from hashlib import sha1
+from multiprocessing import Pool, cpu_count
 
 start_delimiter = "// -------- TEXT AFTER THIS AUTOGENERATED - DO NOT EDIT --------\n"
-start_timestamp = "// Autogenerated by extract_hdrs.py on %s\n"
+start_timestamp = "// Autogenerated by extract_hdrs.py on %s, source SHA-1 %s, v%d\n"
+source_digest_marker = ", source SHA-1 "
 end_delimiter = "// -------- TEXT BEFORE THIS AUTOGENERATED - DO NOT EDIT --------\n"
 
+PAREN_RE = re.compile(r"[()]")
+
+# Change this if the way headers are found changes, so that any existing
+# cached results are ignored, and header files written by an older version
+# are checked again
+CACHE_VERSION = 2
+
 DEBUG = False
 
 class GiveUp(Exception):
     pass
 
-def extract_headers(c_file):
-    """Extract the function headers from this C file.
+def iter_headers(data):
+    r"""Find the commented "extern" function headers in 'data'.
+
+    Yields (header, name) tuples, where 'header' is the text from the opening
+    ``/*`` of the comment to the ``)`` closing the function's arguments, and
+    'name' is the function name.
+
+    The comment must start a line (apart from any indentation), so that a
+    ``/*`` inside a string or a ``//`` comment is not mistaken for one. Any
+    blank lines before the comment are part of the header, except for the
+    newline ending the previous line of code.
+
+    This is a single forward scan through the text. Each search only moves
+    forward, and each bracket is matched once however many candidate headers
+    share it, so the time taken grows linearly with the length of the text.
+
+    For instance:
+
+    >>> list(iter_headers('}\n\n/*\n * Doc\n */\nextern int fred(void)\n{'))
+    [('\n/*\n * Doc\n */\nextern int fred(void)', 'fred')]
+    >>> list(iter_headers('}   \n\n/* Doc */\nextern int fred(void)\n{'))
+    [('\n/* Doc */\nextern int fred(void)', 'fred')]
+    >>> list(iter_headers('  system("rm /dev/shm/*.x");\n}\n\n'
+    ...                   '/* Doc */\nextern int fred(void)\n{'))
+    [('\n/* Doc */\nextern int fred(void)', 'fred')]
+    >>> list(iter_headers('  // cleans up /tmp/* files\n}\n\n'
+    ...                   '/* Doc */\nextern int fred(void)\n{'))
+    [('\n/* Doc */\nextern int fred(void)', 'fred')]
+
+    Many candidates that fail late must not each rescan the rest of the text
+    (with a quadratic scan, these would take minutes):
+
+    >>> list(iter_headers('/**/\nextern int f(\n' * 20000 + '{'))
+    []
+    >>> list(iter_headers('/**/\nextern int x;\n' * 40000 + '{'))
+    []
+    >>> list(iter_headers('/**/\nextern\n' * 20000 +
+    ...                   'f(x)' + ' ' * 20000 + ';{'))
+    []
+    """
+    posn = 0
+
+    # Where the line holding the current "/*" starts, how far we have already
+    # searched back for it, and whether that line has code before a comment
+    line_start = 0
+    line_searched = 0
+    code_line_start = -1
+
+    # The next '(', '{' and ';' after the current declaration. Declarations
+    # only ever move forward through the text, so these do too
+    next_args = data.find('(')
+    next_body = data.find('{')
+    next_semi = data.find(';')
+
+    # The ')' matching each '(' seen so far, found with a stack as we go, and
+    # the result for the last '(' looked at, so that overlapping candidates
+    # never look at the same brackets again
+    closing = {}
+    open_parens = []
+    parens_posn = 0
+    last_args_start = -1
+    last_prototype = None
+
+    def next_from(found, char, start):
+        """Return the next 'char' from 'start', given an earlier 'found' one.
+        """
+        if found == -1 or found >= start:
+            return found
+        return data.find(char, start)
+
+    def find_prototype(args_start, body_start):
+        """Return (args_end, name) for the arguments at 'args_start', or None.
+        """
+        nonlocal parens_posn
+
+        # Find the ')' that matches our '(', which must come before the body
+        for bracket in PAREN_RE.finditer(data, parens_posn, body_start):
+            if bracket.group() == '(':
+                open_parens.append(bracket.start())
+            elif open_parens:
+                closing[open_parens.pop()] = bracket.start()
+        parens_posn = max(parens_posn, body_start)
+        args_end = closing.get(args_start)
+        if args_end is None:
+            return None
+
+        # And there must be nothing but whitespace before the body
+        if skip_whitespace(data, args_end+1) != body_start:
+            return None
+
+        name_end = args_start
+        while data[name_end-1].isspace():
+            name_end -= 1
+        name_start = name_end
+        while data[name_start-1].isalnum() or data[name_start-1] == '_':
+            name_start -= 1
+        if name_start == name_end:
+            return None
+        return args_end, data[name_start:name_end]
+
+    while True:
+        comment_start = data.find('/*', posn)
+        if comment_start == -1:
+            return
+        newline_posn = data.rfind('\n', line_searched, comment_start)
+        if newline_posn != -1:
+            line_start = newline_posn + 1
+        line_searched = comment_start
+        if line_start == code_line_start or \
+           data[line_start:comment_start].strip():
+            code_line_start = line_start
+            posn = comment_start + 2
+            continue
+        comment_end = data.find('*/', comment_start+2)
+        if comment_end == -1:
+            return
+        posn = comment_end + 2
+
+        # The comment must be followed (only) by an "extern" declaration
+        decl_start = skip_whitespace(data, posn)
+        if not data.startswith('extern', decl_start) or \
+           not data[decl_start+6:decl_start+7].isspace():
+            continue
+
+        # Which must be a function with arguments, before any body
+        next_args = next_from(next_args, '(', decl_start)
+        next_body = next_from(next_body, '{', decl_start)
+        next_semi = next_from(next_semi, ';', decl_start)
+        args_start, body_start = next_args, next_body
+        if args_start == -1 or body_start == -1:
+            return
+        if body_start < args_start:
+            continue
+        if next_semi != -1 and next_semi < args_start:
+            continue
+
+        # Every candidate declaration before this '(' gets the same answer
+        if args_start != last_args_start:
+            last_args_start = args_start
+            last_prototype = find_prototype(args_start, body_start)
+        if last_prototype is None:
+            continue
+        args_end, name = last_prototype
+
+        # Keep any blank lines before the comment as part of the header,
+        # starting after the newline that ends the last line of code
+        header_start = comment_start
+        while header_start > 0 and data[header_start-1].isspace():
+            header_start -= 1
+        newline_posn = data.find('\n', header_start, comment_start)
+        if newline_posn != -1:
+            header_start = newline_posn + 1
+
+        posn = body_start
+        yield data[header_start:args_end+1], name
+
+def skip_whitespace(data, posn):
+    """Return the index of the first non-whitespace character from 'posn'.
+    """
+    length = len(data)
+    while posn < length and data[posn].isspace():
+        posn += 1
+    return posn
+
+def read_file(filename):
+    """Return the entire content of the named file, as bytes.
+
+    The file is read in binary mode, in one go, so that it can be hashed
+    before it is decoded (once) with 'decode_text'.
+    """
+    with open(filename, 'rb') as file:
+        return file.read()
+
+def decode_text(data):
+    """Decode the bytes of a C source or header file.
+
+    We only expect ASCII C source, but any other bytes are kept (as
+    surrogates), and restored when the text is written out again with
+    'open_for_writing'.
+    """
+    return data.decode('ascii', 'surrogateescape')
+
+def open_for_writing(filename):
+    """Open the named file for writing text decoded by 'decode_text'.
+    """
+    return open(filename, 'w', encoding='ascii', errors='surrogateescape')
+
+def cache_filename():
+    """Return the name of the file in which we cache the headers we find.
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or \
+                os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'kstate', 'extract-hdrs.json')
+
+def load_cache():
+    """Return our cache of headers found, as a dictionary.
+
+    The keys are absolute C file names, and the values are dictionaries with
+    the 'sha1' of the C file and the (header, name) pairs found in it.
+
+    If the cache does not exist, or cannot be read, or is from a different
+    version of this script, then an empty dictionary is returned. Any entry
+    that does not have the expected shape is left out, so that its C file
+    is simply scanned again.
+    """
+    try:
+        with open(cache_filename()) as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+        return {}
+    files = cache.get('files')
+    if not isinstance(files, dict):
+        return {}
+    return {key: entry for key, entry in files.items()
+            if is_cache_entry(entry)}
+
+def is_cache_entry(entry):
+    """Return True if 'entry' looks like a cache entry made by 'find_headers'.
+
+    >>> is_cache_entry({'sha1': 'abc', 'headers': [['int fred()', 'fred']]})
+    True
+    >>> is_cache_entry({'sha1': 'abc', 'headers': [['int fred()']]})
+    False
+    >>> is_cache_entry(['abc'])
+    False
+    """
+    if not isinstance(entry, dict):
+        return False
+    headers = entry.get('headers')
+    if not isinstance(entry.get('sha1'), str) or not isinstance(headers, list):
+        return False
+    for pair in headers:
+        if not isinstance(pair, list) or len(pair) != 2 or \
+           not all(isinstance(item, str) for item in pair):
+            return False
+    return True
+
+def save_cache(cache):
+    """Save our cache of headers found.
+
+    The cache is only an optimisation, so failure to save it is ignored.
+    """
+    filename = cache_filename()
+    temp_file = filename + '.new'
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(temp_file, 'w') as file:
+            json.dump({'version': CACHE_VERSION, 'files': cache}, file)
+        os.replace(temp_file, filename)
+    except OSError:
+        pass
+
+def find_headers(c_file, c_data, c_digest, cache=None):
+    """Return the (header, name) pairs for the C source text 'c_data'.
+
+    'c_data' is the content of 'c_file', and 'c_digest' is its SHA-1.
+
+    If 'cache' is given, then it is consulted first, and if it does not
+    already know the headers for this C source, they are added to it.
+    """
+    if cache is None:
+        return list(iter_headers(c_data))
+
+    key = os.path.abspath(c_file)
+    entry = cache.get(key)
+    if entry is not None and entry.get('sha1') == c_digest:
+        return entry['headers']
+
+    headers = list(iter_headers(c_data))
+    cache[key] = {'sha1': c_digest, 'headers': headers}
+    return headers
+
+def extract_headers(headers, say=print):
+    """Turn (header, name) pairs, as from 'find_headers', into prototypes.
+
+    Each header is reported by calling 'say'.
 
     Returns text suitable for inclusion into the header file.
     """
-    with open(c_file,'r') as file:
-        data = file.read()
-    headers = re.finditer(pattern, data, re.VERBOSE)
     new = []
-    # Turn our function header into prototypes
-    for hdr in headers:
-        print '  Found ',hdr.group('name')
-        new.append(hdr.group('header')+';\n')
+    for header, name in headers:
+        say(f'  Found  {name}')
+        new.append(header+';\n')
     return ''.join(new)
 
-def split_header_file(h_file):
-    """Split the header file into its three parts and return them.
+def split_header_file(data, h_file):
+    """Split the header file text into its three parts and return them.
+
+    'h_file' is the name of the file the text came from, for error messages.
 
     We have:
 
@@ -129,125 +406,215 @@ def split_header_file(h_file):
     * the middle of the file (inserted by a previous use of this script)
     * the end of the file (written by the user)
     """
-    with open(h_file, 'r') as original:
-        data = original.read()
-
     delimiter1_posn = data.find(start_delimiter)
     delimiter2_posn = data.find(end_delimiter)
 
     if delimiter1_posn == -1:
-        raise GiveUp("Couldn't find start 'AUTOGENERATED' line in file %s"%h_file)
+        raise GiveUp(f"Couldn't find start 'AUTOGENERATED' line in file {h_file}")
 
     if delimiter2_posn == -1:
-        raise GiveUp("Couldn't find end 'AUTOGENERATED' line in file %s"%h_file)
+        raise GiveUp(f"Couldn't find end 'AUTOGENERATED' line in file {h_file}")
 
     start = data[:delimiter1_posn+len(start_delimiter)]
     end   = data[delimiter2_posn:]
 
     middle = data[delimiter1_posn+len(start_delimiter):delimiter2_posn]
     # Drop the previous timestamp line from the beginning
-    lines = middle.splitlines()
-    lines = lines[1:]
-    middle = '\n'.join(lines) + '\n'
+    middle = middle.partition('\n')[2]
 
     return start, middle, end
 
-def process_file(c_file, h_file):
+def source_digest(data):
+    """Return the C source SHA-1 and script version recorded in this header.
+
+    'data' is the header file text, and the result is a (sha1, version)
+    tuple. Returns None if the timestamp line is missing, or does not record
+    both (for instance, because it was written by an older version of this
+    script).
+    """
+    posn = data.find(start_delimiter)
+    if posn == -1:
+        return None
+    posn += len(start_delimiter)
+    line = data[posn:data.find('\n', posn)]
+    marker_posn = line.find(source_digest_marker)
+    if marker_posn == -1:
+        return None
+    digest, _, version = \
+        line[marker_posn+len(source_digest_marker):].partition(', v')
+    if not version.isdigit():
+        return None
+    return digest, int(version)
+
+def report_changes(c_file, middle, new_middle, say=print):
+    """Report how the headers from 'c_file' have changed, by calling 'say'.
+    """
+    say('')
+    say(f'Function definitions for {c_file} have changed')
+    say('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
+    diff = ndiff(middle.splitlines(), new_middle.splitlines())
+    say('\n'.join(diff))
+    say('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
+
+def process_file(c_file, h_file, say=print, backup=False, cache=None):
     """Extract header comments/prototypes from 'c_file' into 'h_file'.
+
+    Progress is reported, a line at a time, by calling 'say'.
+
+    If 'backup' is true, and 'h_file' is rewritten, then its previous content
+    is kept in a '.bak' file.
+
+    If 'cache' is given, it is used (and updated) as described for
+    'find_headers'.
     """
     temp_file = h_file + '.new'
     save_file = h_file + '.bak'
 
-    print 'Extracting headers from %s to %s'%(c_file, h_file)
+    say(f'Extracting headers from {c_file} to {h_file}')
+
+    c_bytes = read_file(c_file)
+    c_digest = sha1(c_bytes).hexdigest()
+    c_data = decode_text(c_bytes)
+    h_data = decode_text(read_file(h_file))
+
+    # If the header file was written after the C file, from the same C
+    # source and by the same version of 'iter_headers', then there is no
+    # need to look at the C source again
+    if os.stat(h_file).st_mtime >= os.stat(c_file).st_mtime and \
+       source_digest(h_data) == (c_digest, CACHE_VERSION):
+        say('Nothing changed')
+        return
 
     # Determine what we want the headers to look like
-    new_middle = extract_headers(c_file)
+    headers = find_headers(c_file, c_data, c_digest, cache)
+    new_middle = extract_headers(headers, say)
 
     # Find out what they were already
     try:
-        start, middle, end = split_header_file(h_file)
+        start, middle, end = split_header_file(h_data, h_file)
     except GiveUp as e:
-        print e
+        say(str(e))
         return
 
     # Do we need to change anything?
-    if DEBUG and middle != new_middle:
-        print
-        print 'Function definitions for %s have changed'%c_file
-        print '>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
-        diff = ndiff(middle.splitlines(), new_middle.splitlines())
-        print '\n'.join(diff)
-        print '>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
-
-    if middle == new_middle:
-        print 'Nothing changed'
+    unchanged = middle == new_middle
+
+    if DEBUG and not unchanged:
+        report_changes(c_file, middle, new_middle, say)
+
+    if unchanged:
+        say('Nothing changed')
     else:
-        print 'Writing new %s'%h_file
+        say(f'Writing new {h_file}')
 
         now = datetime.now()
         timestamp_str = now.strftime('%Y-%m-%d (%a %d %b %Y) at %H:%M')
-        timestamp_line = start_timestamp%timestamp_str
+        timestamp_line = start_timestamp%(timestamp_str, c_digest, CACHE_VERSION)
+
+        with open_for_writing(temp_file) as output:
+            output.writelines((start, timestamp_line, new_middle, end))
+
+        # Copy rather than move the old file to the backup, so that the
+        # single rename below is the only change to 'h_file' itself, and
+        # it is never missing or incomplete
+        if backup:
+            shutil.copy2(h_file, save_file)
+        os.replace(temp_file, h_file)
 
-        with open(temp_file, 'w') as output:
-            output.write(start)
-            output.write(timestamp_line)
-            output.write(new_middle)
-            output.write(end)
+def process_file_quietly(job):
+    """Call 'process_file' for a (c_file, h_file, backup, cache) tuple.
 
-        os.rename(h_file, save_file)
-        os.rename(temp_file, h_file)
+    The output is returned as a list of lines, rather than being printed,
+    so that files processed in parallel do not have their output interleaved.
+
+    Returns (lines, cache), since any change to 'cache' is made in our
+    process, not in our caller's.
+    """
+    c_file, h_file, backup, cache = job
+    lines = []
+    process_file(c_file, h_file, lines.append, backup, cache)
+    return lines, cache
 
 def do_stuff(args):
 
     c_to_h = {}
+    backup = False
+
+    if args and args[0] == '-backup':
+        backup = True
+        args = args[1:]
 
     if not args:
-        filenames = os.listdir('.')
-        for name in filenames:
-            base, ext = os.path.splitext(name)
-            if ext == '.c':
-                c_to_h[name] = '%s_fns.h'%base
+        with os.scandir('.') as entries:
+            for entry in entries:
+                if entry.name.endswith('.c') and entry.is_file():
+                    c_to_h[entry.name] = f'{entry.name[:-2]}_fns.h'
     else:
         while len(args) > 0:
             word = args[0]
             args = args[1:]
             if word in ('-help', '-h', '--help'):
-                print __doc__
+                print(__doc__)
                 return
             elif word == '-kstate':
                 c_to_h = {'kstate.c' : 'kstate.h'}
                 if len(args[1:]) != 0:
-                    print 'Unexpected arguments %s after -kstate'%args[1:]
+                    print(f'Unexpected arguments {args[1:]} after -kstate')
                     return
             else:
                 c_file = word
                 try:
                     h_file = args[0]
                 except:
-                    print 'C file (%s) not matched to a .h file'%c_file
+                    print(f'C file ({c_file}) not matched to a .h file')
                     return
                 c_to_h[c_file] = h_file
                 args = args[1:]
                 if len(args) %2 != 0:
-                    print 'Unbalanced arguments: not pairs of c_file h_file'
+                    print('Unbalanced arguments: not pairs of c_file h_file')
 
     # Basic checks before we do *anything*
     for c_file, h_file in c_to_h.items():
         if not os.path.exists(c_file):
-            print 'C source file %s does not exist'%c_file
+            print(f'C source file {c_file} does not exist')
             return
         if not os.path.exists(h_file):
-            print 'C header file %s does not exist'%h_file
+            print(f'C header file {h_file} does not exist')
             return
         if os.path.splitext(c_file)[-1] != '.c':
-            print 'C source file %s does not have extension .c'%c_file
+            print(f'C source file {c_file} does not have extension .c')
             return
         if os.path.splitext(h_file)[-1] != '.h':
-            print 'C header file %s does not have extension .c'%h_file
+            print(f'C header file {h_file} does not have extension .c')
             return
 
-    for c_file, h_file in c_to_h.items():
-        process_file(c_file, h_file)
+    cache = load_cache()
+    original_cache = dict(cache)
+
+    # Each pair of files is independent of the others, so if we have more
+    # than one pair, process them in parallel
+    if len(c_to_h) > 1:
+        jobs = []
+        for c_file, h_file in c_to_h.items():
+            key = os.path.abspath(c_file)
+            file_cache = {key: cache[key]} if key in cache else {}
+            jobs.append((c_file, h_file, backup, file_cache))
+        with Pool(min(cpu_count(), len(jobs))) as pool:
+            for lines, file_cache in pool.map(process_file_quietly, jobs):
+                for line in lines:
+                    print(line)
+                cache.update(file_cache)
+    else:
+        for c_file, h_file in c_to_h.items():
+            process_file(c_file, h_file, backup=backup, cache=cache)
+
+    # Forget any C files that have gone away, so the cache does not grow
+    # without limit
+    for key in [key for key in cache if not os.path.exists(key)]:
+        del cache[key]
+
+    if cache != original_cache:
+        save_cache(cache)
 
 if __name__ == '__main__':
     do_stuff(sys.argv[1:])
@@ -1,10 +1,10 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """extract_tests.py -- Find "check" tests and put them in a suite
 
 Usage:
             ./extract_tests.py  [-h | -help | --help]
-            ./extract_tests.py  <c_file>
+            ./extract_tests.py  [-backup] <c_file>
 
 Looks for tests declared as::
 
@@ -30,6 +30,9 @@ or::
 
 as appropriate.
 
+If the '-backup' switch is given, and the file is rewritten, then its
+previous content is kept as <c_file>.bak.
+
 It's terribly simple.
 """
 
@@ -60,66 +63,81 @@ It's terribly simple.
 
 import os
 import re
+import shutil
 import sys
 
 from difflib import ndiff
 
-test_pattern = """\
+test_pattern = r"""
 START_TEST\(
-  (?P<test>.*)              # the name of our test
+  (?P<test>[^)\n]*)         # the name of our test (up to the first ')')
 \)
-((                          # followed by
+(                           # optionally followed by
   \s+ // \s+                # a comment starting with spaces and
-  (                         # either
-    expect \s* signal \s*   # the "expect signal" keywords
-    (?P<signal>.*)          # followed by the name of the signal we're expecting
-  ) | (                     # or
-    .*                      # anything (just a comment)
-  )
-  \n
-) | (                       # or
-  \n                        # and EOL
-))
+  expect \s* signal \s*     # the "expect signal" keywords
+  (?P<signal>.*)            # followed by the name of the signal we're expecting
+)?                          # (any other comment is ignored)
 """
 
-file_pattern = """\
+file_pattern = r"""
 (?P<start>
   .*
-  \\n[\t\ ]*//\ START\ TESTS\\n
+  \n[\t\ ]*//\ START\ TESTS\n
 )
 (?P<middle>
   .*
 )
 (?P<end>
-  ^[\t\ ]*//\ END\ TESTS\\n
+  ^[\t\ ]*//\ END\ TESTS\n
   .*
 )
 """
 
+# Our input is ASCII C source, so there's no need for Unicode aware matching
+TEST_RE = re.compile(test_pattern, re.VERBOSE|re.ASCII)
+FILE_RE = re.compile(file_pattern, re.VERBOSE|re.ASCII|re.MULTILINE|re.DOTALL)
+
 DEBUG = False
 
 class GiveUp(Exception):
     pass
 
-def extract_tests(c_file):
-    """Extract the test names
+def read_file(filename):
+    """Return the entire content of the named file, as bytes.
+    """
+    with open(filename, 'rb') as file:
+        return file.read()
+
+def decode_text(data):
+    """Decode the bytes of a C source file.
+
+    Any non-ASCII bytes are kept (as surrogates), so that 'open_for_writing'
+    can write them back out unchanged.
+    """
+    return data.decode('ascii', 'surrogateescape')
+
+def open_for_writing(filename):
+    """Open the named file for writing text decoded by 'decode_text'.
+    """
+    return open(filename, 'w', encoding='ascii', errors='surrogateescape')
+
+def extract_tests(data):
+    """Extract the test names from this C source text
     """
-    with open(c_file,'r') as file:
-        data = file.read()
-    matches = re.finditer(test_pattern, data, re.VERBOSE)
+    matches = TEST_RE.finditer(data)
     tests = []
     for m in matches:
         if m.group('signal'):
-            print '  Found ',m.group('test'), 'expect signal', m.group('signal')
+            print('  Found ', m.group('test'), 'expect signal', m.group('signal'))
             tests.append((m.group('test'), 'signal', m.group('signal')))
         else:
-            print '  Found ',m.group('test')
+            print('  Found ', m.group('test'))
             tests.append((m.group('test'), None, None))
 
     return tests
 
-def split_file(c_file):
-    """Split the header file into its three parts and return them.
+def split_file(data):
+    """Split the C source text into its three parts and return them.
 
     We have:
 
@@ -127,10 +145,7 @@ def split_file(c_file):
     * the middle of the file (inserted by a previous use of this script)
     * the end of the file (written by the user)
     """
-    with open(c_file, 'r') as original:
-        data = original.read()
-
-    match = re.match(file_pattern, data, re.VERBOSE|re.MULTILINE|re.DOTALL)
+    match = FILE_RE.match(data)
     if match is None:
         raise GiveUp('Could not match file to START TESTS...END TESTS pattern\n')
 
@@ -140,74 +155,93 @@ def split_file(c_file):
 
     return start, middle, end
 
-def process_file(c_file):
+def report_changes(c_file, middle, new_middle):
+    """Report how the list of tests in 'c_file' has changed.
+    """
+    print()
+    first_line = middle.partition('\n')[0]
+    print(f'List of tests for {c_file} has changed')
+    print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
+    print(f'"{first_line}"')
+    print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
+    diff = ndiff(middle.splitlines(), new_middle.splitlines())
+    print('\n'.join(diff))
+    print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
+
+def process_file(c_file, backup=False):
     """Update the list of tests in our C file
+
+    If 'backup' is true, and 'c_file' is rewritten, then its previous content
+    is kept in a '.bak' file.
     """
     temp_file = c_file + '.new'
     save_file = c_file + '.bak'
 
-    print 'Finding tests in %s'%(c_file)
+    print(f'Finding tests in {c_file}')
 
-    tests = extract_tests(c_file)
+    data = decode_text(read_file(c_file))
+
+    tests = extract_tests(data)
     if len(tests) == 0:
-        print 'No tests found'
+        print('No tests found')
         return
 
     new_middle = []
     for test, what, signal in tests:
         if what == 'signal':
-            new_middle.append('  tcase_add_test_raise_signal(tc_core, %s, %s);'%(test, signal))
+            new_middle.append(f'  tcase_add_test_raise_signal(tc_core, {test}, {signal});')
         else:
-            new_middle.append('  tcase_add_test(tc_core, %s);'%test)
+            new_middle.append(f'  tcase_add_test(tc_core, {test});')
     new_middle = '\n'.join(new_middle) + '\n'
 
     try:
-        start, middle, end = split_file(c_file)
+        start, middle, end = split_file(data)
     except GiveUp as e:
-        print e
+        print(e)
         return
 
     # Do we need to change anything?
-    if DEBUG and middle != new_middle:
-        print
-        print 'List of tests for %s has changed'%c_file
-        print '>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
-        print '"%s"'%middle.splitlines()[0]
-        print '>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
-        diff = ndiff(middle.splitlines(), new_middle.splitlines())
-        print '\n'.join(diff)
-        print '>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
-
-    if middle == new_middle:
-        print 'Nothing changed'
+    unchanged = middle == new_middle
+
+    if DEBUG and not unchanged:
+        report_changes(c_file, middle, new_middle)
+
+    if unchanged:
+        print('Nothing changed')
     else:
-        print 'Writing new %s'%c_file
+        print(f'Writing new {c_file}')
 
-        with open(temp_file, 'w') as output:
-            output.write(start)
-            output.write(new_middle)
-            output.write(end)
+        with open_for_writing(temp_file) as output:
+            output.writelines((start, new_middle, end))
 
-        os.rename(c_file, save_file)
-        os.rename(temp_file, c_file)
+        # The backup is a copy, so 'c_file' stays in place until the
+        # atomic rename replaces it with the new text
+        if backup:
+            shutil.copy2(c_file, save_file)
+        os.replace(temp_file, c_file)
 
 def do_stuff(args):
 
+    backup = False
+    if args and args[0] == '-backup':
+        backup = True
+        args = args[1:]
+
     if len(args) != 1 or args[0] in ('-help', '-h', '--help'):
-        print __doc__
+        print(__doc__)
         return
 
     c_file = args[0]
 
     # Basic checks before we do *anything*
     if not os.path.exists(c_file):
-        print 'C source file %s does not exist'%c_file
+        print(f'C source file {c_file} does not exist')
         return
     if os.path.splitext(c_file)[-1] != '.c':
-        print 'C source file %s does not have extension .c'%c_file
+        print(f'C source file {c_file} does not have extension .c')
         return
 
-    process_file(c_file)
+    process_file(c_file, backup)
 
 if __name__ == '__main__':
     do_stuff(sys.argv[1:])
@@ -377,22 +377,28 @@ extern void *kstate_get_transaction_ptr(kstate_transaction_p transaction)
   }
 }
 
+/*
+ * Return a string describing the READ/WRITE bits of 'permissions'.
+ *
+ * Any other bits are ignored.
+ */
+static const char *permissions_str(uint32_t permissions)
+{
+  // Indexed by the KSTATE_READ and KSTATE_WRITE bits
+  static const char *const names[] = { "", "read", "write", "read|write" };
+
+  if (!permissions)
+    return "<no permissions>";
+  return names[permissions & (KSTATE_READ | KSTATE_WRITE)];
+}
+
 static void print_state(FILE       *stream,
                         uint32_t    id,
                         const char *name,
                         uint32_t    permissions)
 {
-  fprintf(stream, "State %u on '%s' for ", id, name);
-  if (permissions) {
-    if (permissions & KSTATE_READ)
-      fprintf(stream, "read");
-    if ((permissions & KSTATE_READ) && (permissions & KSTATE_WRITE))
-      fprintf(stream, "|");
-    if (permissions & KSTATE_WRITE)
-      fprintf(stream, "write");
-  } else {
-    fprintf(stream, "<no permissions>");
-  }
+  fprintf(stream, "State %u on '%s' for %s", id, name,
+          permissions_str(permissions));
 }
 
 /*
@@ -429,18 +435,8 @@ static void print_transaction(FILE       *stream,
                               const char *name,
                               uint32_t    permissions)
 {
-  fprintf(stream, "Transaction %u for ", id);
-  if (permissions) {
-    if (permissions & KSTATE_READ)
-      fprintf(stream, "read");
-    if ((permissions & KSTATE_READ) && (permissions & KSTATE_WRITE))
-      fprintf(stream, "|");
-    if (permissions & KSTATE_WRITE)
-      fprintf(stream, "write");
-  } else {
-    fprintf(stream, "<no permissions>");
-  }
-  fprintf(stream, " on '%s'", name);
+  fprintf(stream, "Transaction %u for %s on '%s'", id,
+          permissions_str(permissions), name);
 }
 
 /*
@@ -566,9 +562,11 @@ extern int kstate_subscribe_state(kstate_state_p         state,
     return -EINVAL;
   }
 
+#ifdef KSTATE_DEBUG
   printf("Subscribing to ");
   print_state(stdout, state->id, name, permissions);
   printf("\n");
+#endif
 
   if (state_permissions_are_bad(permissions)) {
     return -EINVAL;
@@ -693,7 +691,9 @@ extern void kstate_unsubscribe_state(kstate_state_p  state)
   if (state == NULL)      // What did they expect us to do?
     return;
 
+#ifdef KSTATE_DEBUG
   kstate_print_state(stdout, "Unsubscribing from ", state, true);
+#endif
 
   if (state->map_addr != NULL && state->map_addr != MAP_FAILED) {
     int rv = munmap(state->map_addr, state->map_length);
@@ -872,7 +872,9 @@ extern int kstate_start_transaction(kstate_transaction_p  transaction,
     return -EINVAL;
   }
 
+#ifdef KSTATE_DEBUG
   kstate_print_state(stdout, "Starting Transaction on ", state, true);
+#endif
 
   if (transaction_permissions_are_bad(permissions)) {
     return -EINVAL;
@@ -985,7 +987,9 @@ extern int kstate_start_transaction(kstate_transaction_p  transaction,
     }
   }
 
+#ifdef KSTATE_DEBUG
   kstate_print_transaction(stdout, "Started ", transaction, true);
+#endif
 
   return 0;
 }
@@ -1018,7 +1022,9 @@ extern int kstate_abort_transaction(kstate_transaction_p  transaction)
     return -EINVAL;
   }
 
+#ifdef KSTATE_DEBUG
   kstate_print_transaction(stdout, "Aborting ", transaction, true);
+#endif
 
   int rv = clear_transaction("kstate_abort_transaction", transaction);
   return rv;
@@ -1061,7 +1067,9 @@ extern int kstate_commit_transaction(struct kstate_transaction  *transaction)
     return -EPERM;
   }
 
+#ifdef KSTATE_DEBUG
   kstate_print_transaction(stdout, "Committing ", transaction, true);
+#endif
 
   int retcode = 0;
 